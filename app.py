@@ -1,93 +1,230 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import jpholiday
 import math
 import datetime
 import calendar
 import json
 import time
+import threading
+import functools
+import bisect
+import hashlib
 from dateutil.relativedelta import relativedelta
 import gspread
+from gspread.utils import ValueRenderOption
 from oauth2client.service_account import ServiceAccountCredentials
+from requests.adapters import HTTPAdapter
 
 # ==========================================
 # 1. 関数定義エリア
 # ==========================================
 
 # --- GSpread 接続 ---
-@st.cache_resource
+@st.cache_resource(show_spinner=False)
 def get_gspread_client():
     key_dict = st.secrets["gcp_service_account"]
     scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
     creds = ServiceAccountCredentials.from_json_keyfile_dict(key_dict, scope)
     client = gspread.authorize(creds)
+    session = getattr(client, "http_client", client).session
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
     return client
 
-@st.cache_resource(ttl=600)
+# スクリプトは実行のたびに新しいモジュールとして読み直されるので、実行をまたいで残すのは st.cache_resource で持つ (期限なし)
+@st.cache_resource(show_spinner=False)
 def get_spreadsheet():
-    client = get_gspread_client()
-    sheet_url = st.secrets["spreadsheet"]["url"]
-    return client.open_by_url(sheet_url)
+    return get_gspread_client().open_by_url(st.secrets["spreadsheet"]["url"])
+
+# シート名→Worksheet の索引。シートごとの sh.worksheet() でメタデータを取りに行かないよう1回で全件引く
+# (add_worksheet_to_sheet でシートを増やしたら作り直す)
+@functools.lru_cache(maxsize=1)
+def _ws_index():
+    return {w.title: w for w in get_spreadsheet().worksheets()}
+
+def get_worksheet(worksheet_name):
+    ws = _ws_index().get(worksheet_name)
+    if ws is None: raise gspread.WorksheetNotFound(worksheet_name)
+    return ws
+
+def add_worksheet_to_sheet(worksheet_name, rows, cols):
+    ws = get_spreadsheet().add_worksheet(title=worksheet_name, rows=rows, cols=cols)
+    _ws_index.cache_clear()
+    return ws
 
 # --- データ読み書き ---
+# 複数セッションからの同時保存で書き込みが混ざらないよう、全セッションで1つのロックで直列化する。
+# スクリプトは実行のたびに新しいモジュールとして読み直されるので、ロックは st.cache_resource で1回だけ作る
+# (保存処理の中から別の保存を呼ぶことがあるため RLock)
+@st.cache_resource(show_spinner=False)
+def _sheets_lock():
+    return threading.RLock()
+
+_SHEETS_LOCK = _sheets_lock()
+
+# --- 書き込みキュー ---
+# シートごとの書き込みを溜めておき、flush_pending_writes で
+# batchUpdate(リサイズ+値のクリア) と values.batchUpdate(値の書き込み) の2リクエストにまとめて送る。
+# 同じシートへの書き込みが複数溜まった場合は最後のものだけを送る
+_PENDING_WRITES = {}
+
+def _queue_sheet_write(worksheet, values, rows=None, cols=None):
+    requests = []
+    if rows is not None:
+        requests.append({"updateSheetProperties": {
+            "properties": {"sheetId": worksheet.id, "gridProperties": {"rowCount": rows, "columnCount": cols}},
+            "fields": "gridProperties/rowCount,gridProperties/columnCount"
+        }})
+        requests.append({"updateCells": {"range": {"sheetId": worksheet.id}, "fields": "userEnteredValue"}})
+    with _SHEETS_LOCK:
+        _PENDING_WRITES[worksheet.title] = {
+            "requests": requests,
+            "data": [{"range": f"'{worksheet.title}'!A1", "values": values, "majorDimension": "ROWS"}]
+        }
+
+def _queue_sheet_ranges(worksheet, ranges):
+    if not ranges: return
+    with _SHEETS_LOCK:
+        _PENDING_WRITES[worksheet.title] = {"requests": [], "data": ranges}
+
+def flush_pending_writes():
+    with _SHEETS_LOCK:
+        if not _PENDING_WRITES: return
+        pending = list(_PENDING_WRITES.values())
+        _PENDING_WRITES.clear()
+        sh = get_spreadsheet()
+        requests = [r for p in pending for r in p["requests"]]
+        if requests:
+            sh.batch_update({"requests": requests})
+        sh.values_batch_update(body={"valueInputOption": "RAW", "data": [d for p in pending for d in p["data"]]})
+
+# 2次元リストのまま受け取り、1行目をヘッダーにして DataFrame を作る (値はすべて文字列)。
+# API が省いた行末の空セルは空文字で埋める
+def _values_to_df(values, default_df=None):
+    if len(values) < 2:
+        return default_df if default_df is not None else pd.DataFrame()
+    width = max(len(row) for row in values)
+    headers, *rows = [list(row) + [""] * (width - len(row)) for row in values]
+    return pd.DataFrame(rows, columns=headers)
+
 def load_data_from_sheet(worksheet_name, default_df=None):
-    sh = get_spreadsheet()
     try:
-        worksheet = sh.worksheet(worksheet_name)
-        data = worksheet.get_all_records()
-        if not data:
-            return default_df if default_df is not None else pd.DataFrame()
-        return pd.DataFrame(data)
+        return _values_to_df(get_worksheet(worksheet_name).get_all_values(), default_df)
     except gspread.WorksheetNotFound:
         if default_df is not None:
             time.sleep(1)
-            worksheet = sh.add_worksheet(title=worksheet_name, rows=100, cols=20)
-            save_data_to_sheet(worksheet_name, default_df)
+            worksheet = add_worksheet_to_sheet(worksheet_name, 100, 20)
+            save_data_to_sheet(worksheet_name, default_df, flush=False)
             return default_df
         return pd.DataFrame()
 
-def save_data_to_sheet(worksheet_name, df):
-    sh = get_spreadsheet()
+# 無いシートをまとめて1回の batchUpdate で作り、既定値を書き込む。
+# 読込キャッシュ (_load_data_cached) の外で、セッションの初回読込の前に毎回行う
+# (キャッシュ済みの読込では副作用が再現されないため)。シート一覧もここで取り直す
+def ensure_sheets(defaults):
+    with _SHEETS_LOCK:
+        _ws_index.cache_clear()
+        missing = [name for name in defaults if name not in _ws_index()]
+        if not missing: return
+        get_spreadsheet().batch_update({"requests": [
+            {"addSheet": {"properties": {"title": name, "gridProperties": {"rowCount": 100, "columnCount": 20}}}}
+            for name in missing
+        ]})
+        _ws_index.cache_clear()
+        for name in missing:
+            save_data_to_sheet(name, defaults[name], flush=False)
+        flush_pending_writes()
+        _load_data_cached.clear()
+
+# 複数のシートを values.batchGet の1リクエストで読む。{シート名: 既定の DataFrame} を受け取り、
+# 無いシート (ensure_sheets の後に消された場合など) は既定の DataFrame をそのまま返す (読むだけで書き込まない)
+def load_sheets_batch(defaults):
+    index = _ws_index()
+    present = [name for name in defaults if name in index]
+    frames = {name: defaults[name] for name in defaults if name not in index}
+    if present:
+        value_ranges = get_spreadsheet().values_batch_get([f"'{name}'" for name in present])["valueRanges"]
+        for name, vr in zip(present, value_ranges):
+            frames[name] = _values_to_df(vr.get("values", []), defaults[name])
+    return frames
+
+# リストが入ったセル(複数選択の名残)は先頭要素にする。object 列だけを見る
+def _unwrap_list_column(col):
+    if col.dtype != object: return col
+    return col.map(lambda x: (x[0] if x else "") if isinstance(x, list) else x)
+
+def save_data_to_sheet(worksheet_name, df, flush=True):
+    with _SHEETS_LOCK:
+        try:
+            worksheet = get_worksheet(worksheet_name)
+        except gspread.WorksheetNotFound:
+            time.sleep(1)
+            worksheet = add_worksheet_to_sheet(worksheet_name, 100, 20)
+
+        headers = [str(c) for c in df.columns]
+        norm = pd.DataFrame({i: _unwrap_list_column(df.iloc[:, i]) for i in range(df.shape[1])}, index=df.index)
+        # 文字列化と欠損の空文字化を表全体で1回ずつ行う
+        str_arr = np.where(norm.isna().to_numpy(), "", norm.astype("string").to_numpy(dtype=object))
+        clean_params = [headers] + str_arr.tolist()
+
+        # 他のセッションが書き換えている可能性があるので差分にはせず、毎回クリアして全体を書き込む
+        _queue_sheet_write(worksheet, clean_params, rows=max(len(clean_params)+10, 100), cols=max(len(headers), 5))
+        if flush:
+            flush_pending_writes()
+            _load_data_cached.clear()
+
+# シートから読んだ文字列の列を数値にする。すべて整数なら Int32 (欠損可) にして "12.0" のような書き戻しを防ぐ
+# (実績の人数・日数や月日はどれも小さいので、int32 に収まらない値があるときだけ Int64 のままにする)
+def to_number_columns(df, cols):
+    for col in cols:
+        if col not in df.columns: continue
+        num = pd.to_numeric(df[col], errors="coerce")
+        valid = num.dropna()
+        if (valid % 1 == 0).all():
+            df[col] = num.astype("Int32" if valid.abs().lt(2**31).all() else "Int64")
+        else:
+            df[col] = num
+    return df
+
+# --- 設定値の保存 ---
+# settings シートは 1行目が見出しと履歴の JSON (C1)、2行目以降が「項目, 値」の行。
+# 文字列・数値・真偽値・日付はセルの値そのままで持ち、リストだけを JSON にする。A1 に全設定の JSON がある旧形式も読める
+SETTINGS_HISTORY_KEYS = ["wage_history", "transport_history", "lunch_history", "capacity_history"]
+SETTINGS_HEADER = ["項目", "値"]
+
+# 設定シートの生のセルだけをキャッシュする (保存時に _fetch_settings_cells.clear() で破棄)
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_settings_cells(sheet_url):
     try:
-        worksheet = sh.worksheet(worksheet_name)
+        # 数値・真偽値は型のまま受け取る (書式を通した文字列にしない)
+        ws = get_worksheet("settings")
+        return [list(row) for row in ws.batch_get(["A:C"], value_render_option=ValueRenderOption.unformatted)[0]]
     except gspread.WorksheetNotFound:
-        time.sleep(1)
-        worksheet = sh.add_worksheet(title=worksheet_name, rows=100, cols=20)
-    
-    headers = df.columns.values.tolist()
-    data_list = df.values.tolist()
-    all_values = [headers] + data_list
-    
-    try:
-        worksheet.resize(rows=max(len(all_values)+10, 100), cols=max(len(headers), 5))
-    except:
-        pass
-    
-    clean_params = []
-    for row in all_values:
-        clean_row = []
-        for cell in row:
-            if isinstance(cell, list):
-                cell = cell[0] if len(cell) > 0 else ""
-            if isinstance(cell, (datetime.date, datetime.datetime, datetime.time)):
-                clean_row.append(str(cell))
-            elif pd.isna(cell):
-                clean_row.append("")
-            else:
-                clean_row.append(str(cell))
-        clean_params.append(clean_row)
-    
-    worksheet.clear()
-    worksheet.update(range_name='A1', values=clean_params)
+        return []
+
+def _settings_from_cells(cells):
+    if not cells or not cells[0] or not cells[0][0]: return None
+    if cells[0][0].lstrip().startswith("{"):
+        return json.loads(cells[0][0])
+    settings = json.loads(cells[0][2]) if len(cells[0]) > 2 and cells[0][2] else {}
+    for row in cells[1:]:
+        if row and row[0]: settings[row[0]] = _settings_value(row[0], row[1] if len(row) > 1 else "")
+    return settings
+
+# 値は既定値の型にそろえる。リストは JSON を戻し、数値・真偽値は文字列で入っていても変換する
+# (float の項目が 40 のように整数で返ってきても 40.0 にする)
+def _settings_value(key, v):
+    default = DEFAULT_SETTINGS.get(key)
+    if v == "" or default is None or isinstance(default, str): return v
+    if isinstance(default, (list, dict)): return json.loads(v)
+    if isinstance(default, bool): return v if isinstance(v, bool) else str(v).upper() == "TRUE"
+    return type(default)(float(v))
 
-# --- 設定値のJSON変換保存 ---
 def load_settings_from_sheet():
-    sh = get_spreadsheet()
     try:
-        ws = sh.worksheet("settings")
-        val = ws.acell('A1').value
-        if val:
-            settings = json.loads(val)
+        settings = _settings_from_cells(_fetch_settings_cells(st.secrets["spreadsheet"]["url"]))
+        if settings:
             keys_to_date = ["opening_date", "wage_start", "transport_start", "lunch_start"]
             keys_to_time = ["open_time", "close_time"]
             
@@ -98,7 +235,7 @@ def load_settings_from_sheet():
                 if k in settings and settings[k]:
                     settings[k] = datetime.datetime.strptime(settings[k], "%H:%M:%S").time()
             
-            for hist_key in ["wage_history", "transport_history", "lunch_history", "capacity_history"]:
+            for hist_key in SETTINGS_HISTORY_KEYS:
                 if hist_key in settings:
                     for item in settings[hist_key]:
                         if item.get("start"):
@@ -111,39 +248,85 @@ def load_settings_from_sheet():
             defaults = _get_default_settings_obj()
             for k, v in defaults.items():
                 if k not in settings: settings[k] = v
-            return settings
-    except (gspread.WorksheetNotFound, json.JSONDecodeError, TypeError):
+            return _attach_settings_indexes(settings)
+    except (ValueError, TypeError):
         pass
-    return _get_default_settings_obj()
+    return _attach_settings_indexes(_get_default_settings_obj())
+
+# 日付・時刻は json.dumps の default で文字列にする (設定の入れ子をたどって変換し直さない)
+def _settings_json_default(v):
+    if isinstance(v, datetime.time): return v.strftime("%H:%M:%S")
+    if isinstance(v, datetime.date): return v.strftime("%Y-%m-%d")
+    raise TypeError(f"{type(v).__name__} は設定に保存できません")
+
+def _settings_dumps(v):
+    return json.dumps(v, ensure_ascii=False, default=_settings_json_default)
+
+def _settings_cell(v):
+    if isinstance(v, (str, bool, int, float)): return v
+    if isinstance(v, (datetime.date, datetime.time)): return _settings_json_default(v)
+    return _settings_dumps(v)
+
+def _settings_to_cells(s_save):
+    hist = {k: s_save[k] for k in SETTINGS_HISTORY_KEYS if k in s_save}
+    rows = [[k, _settings_cell(v), ""] for k, v in s_save.items() if k not in SETTINGS_HISTORY_KEYS]
+    return [SETTINGS_HEADER + [_settings_dumps(hist)]] + rows
 
 def save_settings_to_sheet(settings_dict):
-    s_save = settings_dict.copy()
-    for k, v in s_save.items():
-        if isinstance(v, (datetime.date, datetime.time)):
-            fmt = "%H:%M:%S" if isinstance(v, datetime.time) else "%Y-%m-%d"
-            s_save[k] = v.strftime(fmt)
-    
-    for hist_key in ["wage_history", "transport_history", "lunch_history", "capacity_history"]:
+    s_save = {k: v for k, v in settings_dict.items() if not k.startswith("_")}
+    # 終了日なしはシート上では空文字で持つ
+    for hist_key in SETTINGS_HISTORY_KEYS:
         if hist_key in s_save:
-            new_list = []
-            for item in s_save[hist_key]:
-                new_item = item.copy()
-                if isinstance(new_item.get("start"), datetime.date):
-                    new_item["start"] = new_item["start"].strftime("%Y-%m-%d")
-                if isinstance(new_item.get("end"), datetime.date):
-                    new_item["end"] = new_item["end"].strftime("%Y-%m-%d")
-                else:
-                    new_item["end"] = "" 
-                new_list.append(new_item)
-            s_save[hist_key] = new_list
-
-    json_str = json.dumps(s_save, ensure_ascii=False)
-    sh = get_spreadsheet()
-    try:
-        ws = sh.worksheet("settings")
-    except gspread.WorksheetNotFound:
-        ws = sh.add_worksheet(title="settings", rows=10, cols=10)
-    ws.update_acell('A1', json_str)
+            s_save[hist_key] = [{**item, "end": item.get("end") or ""} for item in s_save[hist_key]]
+
+    cells = _settings_to_cells(s_save)
+    with _SHEETS_LOCK:
+        try:
+            ws = get_worksheet("settings")
+        except gspread.WorksheetNotFound:
+            ws = add_worksheet_to_sheet("settings", 10, 10)
+        # 項目は増えるだけで減らないので、読み直しや差分の計算はせず、見出しから全項目を values.batchUpdate 1回で上書きする。
+        # グリッドに収まらないとき (旧形式の10行のシートなど) だけリサイズ・クリアしてから書く
+        if len(cells) <= ws.row_count:
+            _queue_sheet_ranges(ws, [{"range": "'settings'!A1", "values": cells, "majorDimension": "ROWS"}])
+        else:
+            _queue_sheet_write(ws, cells, rows=max(len(cells) + 10, 30), cols=3)
+        flush_pending_writes()
+        _fetch_settings_cells.clear()
+        _load_data_cached.clear()
+
+# 月次実績の保存は、読み直したシートの内容を「年月」をキーにした dict にして1件を差し替える
+RECORD_COLUMNS = ["年月", "延べ利用者数", "開所日数"]
+
+def records_df_to_dict(df):
+    if df.empty or "年月" not in df.columns: return {}
+    values = to_number_columns(df.reindex(columns=RECORD_COLUMNS[1:]), RECORD_COLUMNS[1:]).to_dict("records")
+    return dict(zip(df["年月"], values))
+
+def with_record_dates(df):
+    # 「2024年4月」形式の年月を月初の日付にした date 列と、期間の絞り込みに使う
+    # 年*100+月 の int32 列 ym_key (読めない年月は 0) を付ける (読込時・保存時に1回だけ行う)。
+    # ym_key の昇順に並べておき、期間の絞り込みは searchsorted で範囲を切り出す
+    df = df.copy()
+    parsed = pd.to_datetime(df["年月"].astype(str), format="%Y年%m月", errors="coerce")
+    df["date"] = parsed.dt.date
+    df["ym_key"] = (parsed.dt.year * 100 + parsed.dt.month).fillna(0).to_numpy(dtype=np.int32)
+    return df.sort_values("ym_key", kind="stable")
+
+# dict に戻すと欠損 (<NA>) が None になり列が float64 に崩れるので、作り直した表も Int32 にそろえ直す
+def records_dict_to_df(records):
+    df = pd.DataFrame.from_records([{"年月": ym, **v} for ym, v in records.items()], columns=RECORD_COLUMNS)
+    return to_number_columns(df, RECORD_COLUMNS[1:])
+
+def upsert_monthly_record(target_ym, total_users, open_days):
+    # 他セッションの保存を取りこぼさないよう、ロック内で最新のシートを読み直してから書き戻す
+    with _SHEETS_LOCK:
+        records = records_df_to_dict(load_data_from_sheet("monthly_records", pd.DataFrame(columns=RECORD_COLUMNS)))
+        records[target_ym] = {"延べ利用者数": total_users, "開所日数": open_days}
+        # 書き込んだ表をそのまま返し、呼び出し側で作り直さない
+        records_df = records_dict_to_df(records)
+        save_data_to_sheet("monthly_records", records_df)
+    return records_df
 
 # --- 共通定数・初期値 ---
 DEFAULT_SETTINGS = {
@@ -165,6 +348,11 @@ DEFAULT_SETTINGS = {
 
 RATIO_MAP = {6.0: "6:1", 7.5: "7.5:1", 10.0: "10:1"}
 JP_DAYS = ["月","火","水","木","金","土","日"]
+JP_DAY_INDEX = {d: i for i, d in enumerate(JP_DAYS)}
+JOB_OPTIONS = ["管理者", "サービス管理責任者", "職業指導員", "生活支援員", "目標工賃達成指導員", "調理員", "運転手", "事務員", "看護職員", "なし"]
+# 人員配置の常勤換算に数える職種と、その区分 (支援員等 / 目標工賃)
+FTE_ROLE_KIND = {"職業指導員": "支援員等", "生活支援員": "支援員等", "目標工賃達成指導員": "目標工賃"}
+EMPLOYMENT_TYPES = ["常勤", "非常勤"]
 
 def _get_default_settings_obj():
     s = DEFAULT_SETTINGS.copy()
@@ -180,7 +368,12 @@ def _get_default_settings_obj():
 def ceil_decimal_1(value):
     return math.ceil(value * 10) / 10
 
-def is_addon_active(target_date, history_list):
+ADDON_HISTORY_KEYS = ["wage_history", "transport_history", "lunch_history"]
+
+def is_addon_active(target_date, history_list, period_arr=None):
+    # period_arr ((開始, 終了) の通日の配列) があれば配列の比較1回で判定する
+    if period_arr is not None:
+        return bool(addon_active_mask(np.array([target_date.toordinal()]), period_arr)[0])
     if not history_list: return False
     t = target_date
     for period in history_list:
@@ -193,7 +386,12 @@ def is_addon_active(target_date, history_list):
             if start <= t <= end: return True
     return False
 
-def get_capacity_at_date(target_date, history_list):
+def get_capacity_at_date(target_date, history_list, cap_index=None):
+    # cap_index (開始日の昇順リスト, 定員のリスト) があれば二分探索で引く
+    if cap_index is not None:
+        starts, counts = cap_index
+        i = bisect.bisect_right(starts, target_date) - 1
+        return 20 if i < 0 else counts[i]
     if not history_list: return 20
     sorted_hist = sorted(history_list, key=lambda x: x['start'])
     current_cap = 20
@@ -204,55 +402,130 @@ def get_capacity_at_date(target_date, history_list):
             break
     return int(current_cap)
 
-def safe_to_date(val):
-    if pd.isnull(val): return None
-    s_val = str(val).strip()
-    s_val = s_val.replace("['", "").replace("']", "").replace('["', "").replace('"]', "").replace("'", "").replace('"', "")
-    if s_val == "": return None
-    try:
-        if isinstance(val, (datetime.date, datetime.datetime)):
-            return val.date() if isinstance(val, datetime.datetime) else val
-        return pd.to_datetime(s_val).date()
-    except:
-        return None
-
-def is_special_holiday_recurring(target_date, holiday_df):
-    t_md = (target_date.month, target_date.day)
-    for _, row in holiday_df.iterrows():
-        try:
-            s_md = (int(row["開始月"]), int(row["開始日"]))
-            e_md = (int(row["終了月"]), int(row["終了日"]))
-            if s_md <= e_md:
-                if s_md <= t_md <= e_md: return True, row["名称"]
-            else:
-                if t_md >= s_md or t_md <= e_md: return True, row["名称"]
-        except ValueError: continue
-    return False, ""
-
-def get_active_staff_df(original_df, settings, target_date_obj=None):
-    df = original_df.copy()
-    df["入社日"] = df["入社日"].apply(safe_to_date)
-    df["退職日"] = df["退職日"].apply(safe_to_date)
+def addon_active_mask(ordinals, period_arr):
+    # 通日の配列それぞれについて、いずれかの加算期間に入っているかの bool 配列を返す
+    o = np.asarray(ordinals, dtype=np.int64)[:, None]
+    return ((period_arr[:, 0] <= o) & (o <= period_arr[:, 1])).any(axis=1)
+
+def _addon_period_arr(history_list):
+    # 終了日なしは date.max までの期間として扱う。開始日のない行は判定に使わない
+    rows = [(h["start"].toordinal(), (h.get("end") or datetime.date.max).toordinal()) for h in history_list if h.get("start")]
+    return np.array(rows, dtype=np.int64).reshape(-1, 2)
+
+# 設定の履歴から検索用のデータを作って settings に載せる。"_" で始まるキーはシートに保存しない
+def _attach_settings_indexes(settings):
+    cap_hist = sorted((h for h in settings.get("capacity_history", []) if h.get("start")), key=lambda x: x["start"])
+    settings["_cap_index"] = ([h["start"] for h in cap_hist], [int(h["count"]) for h in cap_hist])
+    for key in ADDON_HISTORY_KEYS:
+        settings[f"_{key}_arr"] = _addon_period_arr(settings.get(key, []))
+    return settings
+
+# 日付の列を1列まとめて記号除去・日付変換し、変換できない値は None にする
+# (比較に使うときは datetime64 のままの parse_date_series を使い、date への変換を挟まない)
+def parse_date_series(series):
+    cleaned = series.astype("string").str.replace(r"[\[\]'\"]", "", regex=True).str.strip().replace("", pd.NA)
+    return pd.to_datetime(cleaned, errors="coerce", format="mixed")
+
+def dates_from_parsed(parsed):
+    return parsed.dt.date.astype(object).where(parsed.notna(), None)
+
+def safe_to_date_series(series):
+    return dates_from_parsed(parse_date_series(series))
+
+# 特別休暇ルールを 月*100+日 の整数 (開始, 終了) と名称の配列にする。
+# 読込時に holidays.attrs["mdays"] に載せておき、判定のたびに行を走査しない
+def _holiday_md_arrays(holiday_df):
+    cached = holiday_df.attrs.get("mdays")
+    if cached is None:
+        # 4列まとめて数値化し、どれか1つでも数値にならない行はルールから外す
+        md = holiday_df[["開始月", "開始日", "終了月", "終了日"]].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=float)
+        valid = np.isfinite(md).all(axis=1)
+        md = md[valid].astype(np.int64)
+        starts, ends = md[:, 0] * 100 + md[:, 1], md[:, 2] * 100 + md[:, 3]
+        cached = (tuple(starts.tolist()), tuple(ends.tolist()), tuple(holiday_df["名称"].to_numpy(dtype=object)[valid].tolist()))
+    starts, ends, names = cached
+    return np.array(starts, dtype=np.int16), np.array(ends, dtype=np.int16), np.array(names, dtype=object)
+
+def attach_holiday_keys(holiday_df):
+    # 編集後の表に古い attrs が引き継がれている場合があるので、作り直してから載せる
+    holiday_df.attrs.pop("mdays", None); holiday_df.attrs.pop("sp_rules", None)
+    starts, ends, names = _holiday_md_arrays(holiday_df)
+    holiday_df.attrs["mdays"] = (tuple(starts.tolist()), tuple(ends.tolist()), tuple(names.tolist()))
+    # 月カレンダー・ビットマップのキャッシュキーになる (開始, 終了) の組もここで作っておく
+    holiday_df.attrs["sp_rules"] = tuple(zip(*holiday_df.attrs["mdays"][:2]))
+    return holiday_df
+
+def _special_holiday_hits(md_keys, starts, ends):
+    # (日付数, ルール数) の判定行列。終了が開始より前のルールは年をまたぐ期間として扱う
+    t = md_keys[:, None]
+    wrap = ends < starts
+    return (~wrap & (starts <= t) & (t <= ends)) | (wrap & ((t >= starts) | (t <= ends)))
+
+def _holiday_rules(holiday_df):
+    cached = holiday_df.attrs.get("sp_rules")
+    if cached is not None: return cached
+    starts, ends, _ = _holiday_md_arrays(holiday_df)
+    return tuple(zip(starts.tolist(), ends.tolist()))
+
+# 特別休暇を年単位のビットマップ(通日でインデックス)に展開しておき、日付ごとの判定を配列参照にする
+@st.cache_data(show_spinner=False)
+def build_sp_bitmap(year, rules):
+    mask = np.zeros(367, dtype=bool)
+    days = pd.date_range(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+    if rules:
+        starts, ends = (np.array(col, dtype=np.int16) for col in zip(*rules))
+        md = (days.month * 100 + days.day).to_numpy()
+        mask[days.dayofyear.to_numpy()[_special_holiday_hits(md, starts, ends).any(axis=1)]] = True
+    return mask
+
+# 祝日も年単位のビットマップにしておき、休業曜日や特別休暇の設定を変えても jpholiday を引き直さない
+@st.cache_data(show_spinner=False)
+def build_national_holiday_bitmap(year):
+    mask = np.zeros(367, dtype=bool)
+    mask[[d.timetuple().tm_yday for d, _ in jpholiday.year_holidays(year)]] = True
+    return mask
+
+# 月ごとの初日・末日、日付ラベル・曜日と休業日をまとめて作ってキャッシュする (実績タブとシフト作成タブで共用)
+@st.cache_data(show_spinner=False)
+def compute_month_calendar(year, month, closed_days, close_on_holiday, sp_rules):
+    dates = pd.date_range(datetime.date(year, month, 1), periods=calendar.monthrange(year, month)[1])
+    weekdays = dates.weekday.to_numpy().astype(np.int8)
+    # 「日(曜)」のラベルは日番号と曜日名の配列を文字列連結して一度に作る
+    labels = (dates.day.astype(str) + "(" + pd.Index(np.array(JP_DAYS, dtype=object)[weekdays]) + ")").to_numpy(dtype=object)
+    # 休業曜日の bool 配列に、祝日・特別休暇の日ごとの bool 配列を OR する
+    closed = np.isin(weekdays, [JP_DAY_INDEX[w] for w in closed_days if w in JP_DAY_INDEX])
+    if close_on_holiday:
+        closed |= build_national_holiday_bitmap(year)[dates.dayofyear.to_numpy()]
+    closed |= build_sp_bitmap(year, sp_rules)[dates.dayofyear.to_numpy()]
+    return {
+        "open_days": int((~closed).sum()),
+        "date_labels": tuple(labels.tolist()),
+        "holiday_labels": tuple(labels[closed].tolist()),
+        "holiday_mask": tuple(closed.tolist()),
+        "weekdays": tuple(weekdays.tolist()),
+        "first_day": dates[0].date(), "last_day": dates[-1].date(),
+    }
+
+# 在籍判定だけに使う呼び出しでは元の表をコピーせず、絞り込んだ結果 (.loc) を返す。
+# 編集画面に渡すときだけ copy=True で複製し、日付列を date にそろえる
+def get_active_staff_df(original_df, settings, target_date_obj=None, copy=False):
+    # 日付は1回だけ datetime64 に解析し、表示用の date 列と在籍判定の両方に使う
+    hire = parse_date_series(original_df["入社日"]); resign = parse_date_series(original_df["退職日"])
+    df = original_df
+    if copy:
+        df = original_df.copy()
+        df["入社日"] = dates_from_parsed(hire)
+        df["退職日"] = dates_from_parsed(resign)
 
     if target_date_obj:
-        last_day = calendar.monthrange(target_date_obj.year, target_date_obj.month)[1]
-        month_end = datetime.date(target_date_obj.year, target_date_obj.month, last_day)
-        
-        active_mask = []
-        for _, row in df.iterrows():
-            hire_date = row["入社日"]
-            resign_date = row["退職日"]
-            is_hired = True
-            if pd.notnull(hire_date) and hire_date > month_end: is_hired = False
-            is_resigned = False
-            if pd.notnull(resign_date) and resign_date < target_date_obj: is_resigned = True
-            active_mask.append(is_hired and not is_resigned)
-        df = df[active_mask]
+        target_ts = pd.Timestamp(target_date_obj)
+        month_end_ts = target_ts + pd.offsets.MonthEnd(0)
+        df = df.loc[(hire.isna() | (hire <= month_end_ts)) & (resign.isna() | (resign >= target_ts))]
 
         exclude_targets = []
-        wage_active = is_addon_active(target_date_obj, settings.get("wage_history", []))
-        lunch_active = is_addon_active(target_date_obj, settings.get("lunch_history", []))
-        trans_active = is_addon_active(target_date_obj, settings.get("transport_history", []))
+        wage_active = is_addon_active(target_date_obj, settings.get("wage_history", []), settings.get("_wage_history_arr"))
+        lunch_active = is_addon_active(target_date_obj, settings.get("lunch_history", []), settings.get("_lunch_history_arr"))
+        trans_active = is_addon_active(target_date_obj, settings.get("transport_history", []), settings.get("_transport_history_arr"))
         
         if not wage_active: exclude_targets.append("目標工賃達成指導員")
         if not lunch_active: exclude_targets.append("調理員")
@@ -263,8 +536,40 @@ def get_active_staff_df(original_df, settings, target_date_obj=None):
         
     return df
 
+# 在籍職員の常勤換算 (支援員等・目標工賃) と内訳。列ごとの計算1回で済むので、表全体をハッシュするキャッシュは使わない
+def compute_staff_fte(current_staff_df, fulltime_weekly_hours):
+    # 主・副それぞれの常勤換算を列ごとにまとめて計算する (数値にできない行は 0 時間扱い)
+    total_h = pd.to_numeric(current_staff_df["契約時間(週)"], errors="coerce")
+    sub_h = pd.to_numeric(current_staff_df["兼務時間(週)"], errors="coerce")
+    invalid = total_h.isna() | sub_h.isna()
+    total_h = total_h.mask(invalid, 0.0).to_numpy(dtype=float); sub_h = sub_h.mask(invalid, 0.0).to_numpy(dtype=float)
+    main_fte = np.maximum(0, total_h - sub_h) / fulltime_weekly_hours
+    sub_fte = sub_h / fulltime_weekly_hours
+    # 職種→区分の対応表で主・副を1回ずつ引き、区分ごとに合計する (対象外の職種は "")
+    main_kind = current_staff_df["職種(主)"].astype(object).map(FTE_ROLE_KIND).fillna("").to_numpy(dtype=object)
+    sub_kind = current_staff_df["職種(副)"].astype(object).map(FTE_ROLE_KIND).fillna("").to_numpy(dtype=object)
+    actual_base_fte = float(main_fte[main_kind == "支援員等"].sum() + sub_fte[sub_kind == "支援員等"].sum())
+    actual_wage_fte = float(main_fte[main_kind == "目標工賃"].sum() + sub_fte[sub_kind == "目標工賃"].sum())
+
+    # 内訳は (名前, 主/副, 区分, 常勤換算) のタプルで返し、文字列にするのは表示時だけ
+    details_log = tuple(
+        (name, tag, str(kind), float(fte))
+        for name, mk, mf, sk, sf in zip(current_staff_df["名前"], main_kind, main_fte, sub_kind, sub_fte)
+        for tag, kind, fte in (("主", mk, mf), ("副", sk, sf)) if kind and fte > 0
+    )
+    return actual_base_fte, actual_wage_fte, details_log
+
+def calculate_average_users_detail(target_date, opening_date, capacity_history, records_df, cap_index=None):
+    # 同じ月・同じ実績での再計算を避けるため、引数をハッシュ可能なキーにしてキャッシュ版を呼ぶ
+    cap_key = tuple((h.get("start"), h.get("count")) for h in capacity_history)
+    records_key = hashlib.blake2b(pd.util.hash_pandas_object(records_df, index=False).values.tobytes()).hexdigest()
+    return _calc_avg_cached(target_date, opening_date, cap_key, records_key, records_df, cap_index)
+
 # 【重要修正】平均利用人数の計算ロジック（4段階）
-def calculate_average_users_detail(target_date, opening_date, capacity_history, records_df):
+@st.cache_data(show_spinner=False)
+def _calc_avg_cached(target_date, opening_date, cap_key, records_key, _records_df, _cap_index=None):
+    capacity_history = [{"start": start, "count": count} for start, count in cap_key]
+    records_df = _records_df
     explanation = { "rule_name": "", "period_start": "", "period_end": "", "details_df": None, "formula": "", "result": 0.0 }
     
     # 0. 基本情報の整理
@@ -276,7 +581,7 @@ def calculate_average_users_detail(target_date, opening_date, capacity_history,
     months_passed = diff.years * 12 + diff.months
     
     # 定員の取得
-    current_capacity = get_capacity_at_date(target_date, capacity_history)
+    current_capacity = get_capacity_at_date(target_date, capacity_history, _cap_index)
     
     # --- ケース1: 開所6ヶ月間 (months_passed: 0~5) ---
     if months_passed < 6:
@@ -291,8 +596,9 @@ def calculate_average_users_detail(target_date, opening_date, capacity_history,
         explanation["formula"] = "計算に必要な実績データがありません"
         return explanation
     
-    df_recs = records_df.copy()
-    df_recs["date"] = pd.to_datetime(df_recs["年月"].astype(str).str.replace("年", "-").str.replace("月", "-01")).dt.date
+    df_recs = records_df
+    if "ym_key" not in df_recs.columns:
+        df_recs = with_record_dates(records_df)
     
     # 前年度の期間を定義 (4月始まり)
     # target_dateが属する年度の「前年度」
@@ -325,8 +631,11 @@ def calculate_average_users_detail(target_date, opening_date, capacity_history,
         rule_name = f"【直近12ヶ月実績】({target_start.strftime('%Y年%m月')} ～ {target_end.strftime('%Y年%m月')})"
 
     # 対象期間のデータを抽出
-    mask = (df_recs["date"] >= target_start) & (df_recs["date"] <= target_end)
-    target_df = df_recs[mask].sort_values("date")
+    # 年月キーは昇順に並んでいるので、二分探索で期間の先頭・末尾の位置を求めて連続した範囲を切り出す
+    ym_keys = df_recs["ym_key"].to_numpy()
+    lo = np.searchsorted(ym_keys, target_start.year * 100 + target_start.month, side="left")
+    hi = np.searchsorted(ym_keys, target_end.year * 100 + target_end.month, side="right")
+    target_df = df_recs.iloc[lo:hi]
     
     if target_df.empty:
         explanation["rule_name"] = "実績不足"
@@ -349,63 +658,135 @@ def calculate_average_users_detail(target_date, opening_date, capacity_history,
     
     return explanation
 
-def load_data():
-    data = {}
-    data["settings"] = load_settings_from_sheet()
+# 選択肢から空欄と重複を除く (カテゴリは一意で欠損を含められないため)
+def unique_options(values):
+    return tuple(dict.fromkeys(v for v in values if pd.notna(v) and v != ""))
+
+def as_category(series, options):
+    categories = list(unique_options(options))
+    extra = [v for v in series.dropna().unique().tolist() if v not in categories]
+    return pd.Categorical(series, categories=categories + extra)
 
+# 職員表の選択肢が決まっている文字列列をカテゴリ型にそろえる (読込時と、行の追加で型が崩れうる編集後の保存時)。
+# 固定休は自由入力なのでカテゴリにしない (data_editor がカテゴリ列を選択式にしてしまうため)
+def categorize_staff_columns(df_staff, shift_codes):
+    for col, options in [("職種(主)", JOB_OPTIONS), ("職種(副)", JOB_OPTIONS), ("雇用形態", EMPLOYMENT_TYPES), ("基本シフト", shift_codes)]:
+        df_staff[col] = as_category(df_staff[col], options)
+    return df_staff
+
+# マスタ類・実績・下書きの各シートの既定値。読込側で列を書き換えるので呼ぶたびに作り直す
+def default_sheet_frames():
     default_staff = pd.DataFrame([
         {"名前": "管理者A", "職種(主)": "管理者", "職種(副)": "なし", "雇用形態": "常勤", "契約時間(週)": 40.0, "兼務時間(週)": 0.0, "基本シフト": "A", "固定休": "土,日", "入社日": "2024-04-01", "退職日": ""},
     ])
-    df_staff = load_data_from_sheet("staff_master", default_staff)
+    default_users = pd.DataFrame([
+        {"利用者名": "山田太郎", "利用開始日": "2025-01-01", "利用終了日": "", "支給決定量タイプ": "原則日数(月-8)", "固定日数": 0}
+    ])
+    default_patterns = pd.DataFrame([
+        {"コード": "A", "名称": "日勤A", "開始": "09:00:00", "終了": "16:00:00", "休憩(分)": 60},
+    ])
+    default_holidays = pd.DataFrame([
+        {"名称": "年末年始", "開始月": 12, "開始日": 29, "終了月": 1, "終了日": 3},
+    ])
+    return {
+        "staff_master": default_staff, "users_master": default_users, "shift_patterns": default_patterns,
+        "holidays": default_holidays, "monthly_records": pd.DataFrame(columns=RECORD_COLUMNS), "current_shift_draft": pd.DataFrame(),
+    }
+
+# 読込結果はセッションをまたいでキャッシュし、保存時 (save_data_to_sheet / save_settings_to_sheet) に破棄する
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_data_cached(sheet_url):
+    data = {}
+    data["settings"] = load_settings_from_sheet()
+
+    # マスタ類と実績・下書きのシートは1回のリクエストでまとめて読む
+    sheets = load_sheets_batch(default_sheet_frames())
+
+    df_staff = sheets["staff_master"]
     
     required_cols_staff = ["名前", "職種(主)", "職種(副)", "雇用形態", "契約時間(週)", "兼務時間(週)", "基本シフト", "固定休", "入社日", "退職日"]
     for col in required_cols_staff:
         if col not in df_staff.columns: df_staff[col] = None
 
-    df_staff["入社日"] = df_staff["入社日"].apply(safe_to_date)
-    df_staff["退職日"] = df_staff["退職日"].apply(safe_to_date)
+    df_staff["入社日"] = safe_to_date_series(df_staff["入社日"])
+    df_staff["退職日"] = safe_to_date_series(df_staff["退職日"])
     df_staff["契約時間(週)"] = pd.to_numeric(df_staff["契約時間(週)"], errors='coerce').fillna(0.0)
     df_staff["兼務時間(週)"] = pd.to_numeric(df_staff["兼務時間(週)"], errors='coerce').fillna(0.0)
     data["staff"] = df_staff
 
     # 利用者マスタ
-    default_users = pd.DataFrame([
-        {"利用者名": "山田太郎", "利用開始日": "2025-01-01", "利用終了日": "", "支給決定量タイプ": "原則日数(月-8)", "固定日数": 0}
-    ])
-    df_users = load_data_from_sheet("users_master", default_users)
+    df_users = sheets["users_master"]
     required_cols_users = ["利用者名", "利用開始日", "利用終了日", "支給決定量タイプ", "固定日数"]
     for col in required_cols_users:
         if col not in df_users.columns: df_users[col] = None
-    df_users["利用開始日"] = df_users["利用開始日"].apply(safe_to_date)
-    df_users["利用終了日"] = df_users["利用終了日"].apply(safe_to_date)
+    df_users["利用開始日"] = safe_to_date_series(df_users["利用開始日"])
+    df_users["利用終了日"] = safe_to_date_series(df_users["利用終了日"])
     df_users["固定日数"] = pd.to_numeric(df_users["固定日数"], errors='coerce').fillna(0)
     data["users"] = df_users
 
-    default_patterns = pd.DataFrame([
-        {"コード": "A", "名称": "日勤A", "開始": "09:00:00", "終了": "16:00:00", "休憩(分)": 60},
-    ])
-    df_ptn = load_data_from_sheet("shift_patterns", default_patterns)
+    df_ptn = to_number_columns(sheets["shift_patterns"], ["休憩(分)"])
     df_ptn["開始"] = pd.to_datetime(df_ptn["開始"], format='%H:%M:%S').dt.time
     df_ptn["終了"] = pd.to_datetime(df_ptn["終了"], format='%H:%M:%S').dt.time
     data["patterns"] = df_ptn
+    # 選択肢が決まっている文字列列はカテゴリ型で持つ (選択肢にない既存値もカテゴリに含めて値を落とさない)
+    categorize_staff_columns(df_staff, shift_code_list(df_ptn))
 
-    default_holidays = pd.DataFrame([
-        {"名称": "年末年始", "開始月": 12, "開始日": 29, "終了月": 1, "終了日": 3},
-    ])
-    data["holidays"] = load_data_from_sheet("holidays", default_holidays)
+    data["holidays"] = attach_holiday_keys(to_number_columns(sheets["holidays"], ["開始月", "開始日", "終了月", "終了日"]))
 
-    default_records = pd.DataFrame(columns=["年月", "延べ利用者数", "開所日数"])
-    data["records"] = load_data_from_sheet("monthly_records", default_records)
+    data["records"] = with_record_dates(to_number_columns(sheets["monthly_records"], RECORD_COLUMNS[1:]))
 
-    data["draft_shift"] = load_data_from_sheet("current_shift_draft", pd.DataFrame())
+    data["draft_shift"] = sheets["current_shift_draft"]
     if data["draft_shift"].empty:
         data["draft_shift"] = None 
 
     return data
 
+def load_data():
+    ensure_sheets(default_sheet_frames())
+    return _load_data_cached(st.secrets["spreadsheet"]["url"])
+
+HOLIDAY_CELL_CSS = "background-color: #ffe6e6; color: #cc0000"
+
+# 休日列の CSS 表は (行ラベル, 列, 休日列) が同じ間は作り直さずに使い回す (Styler は読むだけで書き換えない)
+@st.cache_resource(show_spinner=False, max_entries=16)
+def _holiday_style_matrix(index, columns, holiday_cols):
+    css = np.where(np.isin(np.array(columns, dtype=object), list(holiday_cols)), HOLIDAY_CELL_CSS, "")
+    return pd.DataFrame(np.broadcast_to(css, (len(index), len(columns))), index=list(index), columns=list(columns))
+
+def holiday_style_frame(df, holiday_cols):
+    return _holiday_style_matrix(tuple(df.index), tuple(df.columns), tuple(holiday_cols))
+
+# 表の内容(列名を含む)のハッシュ。シフト下書きが変わったときだけ CSV を作り直すのに使う
+def frame_digest(df):
+    if df is None: return None
+    h = hashlib.blake2b(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    h.update("\x1f".join(map(str, df.columns)).encode())
+    return h.hexdigest()
+
+# 勤務区分コードの一覧は読込時・勤務区分の保存時にだけ作り直し、st.session_state._shift_codes
+# (シフト表の選択肢は休み区分を足した _shift_opts) にタプルで保持する
+SHIFT_OFF_OPTIONS = ("休", "公休", "有給")
+
+def shift_code_list(patterns_df):
+    return unique_options(patterns_df["コード"]) if not patterns_df.empty else ()
+
+def set_shift_codes(patterns_df):
+    st.session_state._shift_codes = shift_code_list(patterns_df)
+    st.session_state._shift_opts = st.session_state._shift_codes + SHIFT_OFF_OPTIONS
+
+# シフト表の列設定は (日付列, 勤務区分) ごとに1回だけ作り、セッションをまたいで共有する
+# (data_editor 側で deepcopy してから使うので共有しても書き換えられない)
+@st.cache_resource(show_spinner=False)
+def make_shift_col_config(date_cols, shift_opts):
+    return {"氏名": st.column_config.TextColumn("氏名", disabled=True)} | {
+        d_col: st.column_config.SelectboxColumn(d_col, options=list(shift_opts), required=True, width="small")
+        for d_col in date_cols
+    }
+
+# 保存した内容は各保存処理で st.session_state に反映済みなので、シートは読み直さず
+# 読込キャッシュだけを捨てて再描画する (次にセッションを開いたときに最新を読む)
 def reload_all_data():
-    if 'data_loaded' in st.session_state:
-        del st.session_state['data_loaded']
+    _load_data_cached.clear()
     st.rerun()
 
 # ==========================================
@@ -421,9 +802,12 @@ if 'data_loaded' not in st.session_state:
         st.session_state.staff_db = data["staff"]
         st.session_state.users_db = data["users"]
         st.session_state.shift_patterns = data["patterns"]
+        set_shift_codes(data["patterns"])
         st.session_state.special_holidays_list = data["holidays"]
         st.session_state.monthly_records = data["records"]
-        st.session_state.current_shift_df = data["draft_shift"]
+        # 編集中のシフト下書きはセッション側を正とし、シートからは初回のみ読み込む
+        if st.session_state.get("current_shift_df") is None:
+            st.session_state.current_shift_df = data["draft_shift"]
         if "temp_users_calc" not in st.session_state:
             st.session_state.temp_users_calc = None
         st.session_state.data_loaded = True
@@ -445,7 +829,7 @@ with st.sidebar.expander("詳細設定を開く"):
         s_fac_name = st.text_input("事業所名", value=st.session_state.settings["facility_name"])
         s_open_date = st.date_input("開所年月日", value=st.session_state.settings["opening_date"])
         
-        current_cap = get_capacity_at_date(today, st.session_state.settings.get('capacity_history', []))
+        current_cap = get_capacity_at_date(today, st.session_state.settings.get('capacity_history', []), st.session_state.settings.get("_cap_index"))
         st.info(f"現在の定員: **{current_cap}名** (履歴管理中)")
         
         st.subheader("体制・営業時間")
@@ -459,14 +843,12 @@ with st.sidebar.expander("詳細設定を開く"):
         s_close_holiday = st.checkbox("祝日は休みにする", value=st.session_state.settings["close_on_holiday"])
         
         if st.form_submit_button("設定を保存"):
-            new_settings = st.session_state.settings.copy()
-            new_settings.update({
+            st.session_state.settings.update({
                 "facility_name": s_fac_name, "opening_date": s_open_date,
                 "open_time": s_open_time, "close_time": s_close_time, "fulltime_hours": s_fulltime,
                 "closed_days": s_closed_days, "close_on_holiday": s_close_holiday, "service_ratio": s_ratio_val
             })
-            st.session_state.settings = new_settings
-            save_settings_to_sheet(new_settings)
+            save_settings_to_sheet(st.session_state.settings)
             st.success("設定を保存しました")
             reload_all_data()
 
@@ -474,6 +856,9 @@ fulltime_weekly_hours = st.session_state.settings["fulltime_hours"]
 service_ratio = st.session_state.settings.get("service_ratio", 6.0)
 closed_days_select = st.session_state.settings["closed_days"]
 close_on_holiday = st.session_state.settings["close_on_holiday"]
+# 月カレンダーのキャッシュキー (休業曜日と特別休暇の期間) は再描画ごとに1回だけ作る
+closed_days_key = tuple(closed_days_select)
+sp_holiday_rules = _holiday_rules(st.session_state.special_holidays_list)
 
 # ==========================================
 # メイン画面 (メニュー分岐)
@@ -488,6 +873,9 @@ if menu == "マスタ・休暇設定":
     with c_p2:
         if st.button("勤務区分を保存"):
             st.session_state.shift_patterns = edited_patterns
+            set_shift_codes(edited_patterns)
+            # 追加した勤務区分を職員表の基本シフト列でも持てるよう、カテゴリを作り直す
+            categorize_staff_columns(st.session_state.staff_db, st.session_state._shift_codes)
             save_data_to_sheet("shift_patterns", edited_patterns)
             st.success("保存しました"); reload_all_data()
     st.divider()
@@ -498,35 +886,28 @@ if menu == "マスタ・休暇設定":
         df_cap = pd.DataFrame(curr_cap_hist)
         if "start" not in df_cap.columns: df_cap["start"] = pd.Series(dtype='datetime64[ns]')
         if "count" not in df_cap.columns: df_cap["count"] = 20
-        df_cap["start"] = df_cap["start"].apply(safe_to_date)
-        df_cap["count"] = pd.to_numeric(df_cap["count"], errors='coerce').fillna(20)
+        df_cap["start"] = safe_to_date_series(df_cap["start"])
+        df_cap["count"] = pd.to_numeric(df_cap["count"], errors='coerce').fillna(20).astype(int)
         cap_col_cfg = {"start": st.column_config.DateColumn("開始日", required=True), "count": st.column_config.NumberColumn("定員数", min_value=20, max_value=60, step=1, required=True)}
         new_cap_df = st.data_editor(df_cap, column_config=cap_col_cfg, num_rows="dynamic", use_container_width=True, key="editor_capacity")
     with col_cap2:
         if st.button("定員履歴を保存"):
             def df_to_list_cap(df):
-                res = []
-                for _, row in df.iterrows():
-                    s = row["start"]; c = row["count"]
-                    if not s: continue
-                    if isinstance(s, pd.Timestamp): s = s.date()
-                    res.append({"start": s, "count": int(c)})
-                return res
-            new_settings = st.session_state.settings.copy()
-            new_settings["capacity_history"] = df_to_list_cap(new_cap_df)
-            st.session_state.settings = new_settings
-            save_settings_to_sheet(new_settings)
+                starts = pd.to_datetime(df["start"], errors="coerce")
+                keep = starts.notna()
+                return [{"start": s, "count": int(c)} for s, c in zip(starts[keep].dt.date, df.loc[keep, "count"])]
+            st.session_state.settings["capacity_history"] = df_to_list_cap(new_cap_df)
+            _attach_settings_indexes(st.session_state.settings)
+            save_settings_to_sheet(st.session_state.settings)
             st.success("保存しました"); reload_all_data()
     st.divider()
     st.subheader("3. 加算取得期間の設定")
     col_a1, col_a2, col_a3 = st.columns(3)
     def render_history_editor(key, title):
         current_list = st.session_state.settings.get(key, [])
-        df_hist = pd.DataFrame(current_list)
-        if "start" not in df_hist.columns: df_hist["start"] = pd.Series(dtype='datetime64[ns]')
-        if "end" not in df_hist.columns: df_hist["end"] = pd.Series(dtype='datetime64[ns]')
-        df_hist["start"] = df_hist["start"].apply(safe_to_date)
-        df_hist["end"] = df_hist["end"].apply(safe_to_date)
+        df_hist = pd.DataFrame(current_list, columns=["start", "end"])
+        df_hist["start"] = pd.to_datetime(df_hist["start"], errors="coerce").dt.date
+        df_hist["end"] = pd.to_datetime(df_hist["end"], errors="coerce").dt.date
         column_cfg = {"start": st.column_config.DateColumn("開始日", required=True), "end": st.column_config.DateColumn("終了日")}
         st.markdown(f"**{title}**")
         return st.data_editor(df_hist, column_config=column_cfg, num_rows="dynamic", use_container_width=True, key=f"editor_{key}")
@@ -535,22 +916,17 @@ if menu == "マスタ・休暇設定":
     with col_a3: new_lunch_df = render_history_editor("lunch_history", "食事提供加算")
     if st.button("加算設定を保存"):
         def df_to_list(df):
-            res = []
-            for _, row in df.iterrows():
-                s, e = row["start"], row["end"]
-                if not s: continue 
-                if isinstance(s, pd.Timestamp): s = s.date()
-                if isinstance(e, pd.Timestamp): e = e.date()
-                if pd.isna(s): continue
-                if pd.isna(e): e = None
-                res.append({"start": s, "end": e})
-            return res
-        new_settings = st.session_state.settings.copy()
-        new_settings["wage_history"] = df_to_list(new_wage_df)
-        new_settings["transport_history"] = df_to_list(new_trans_df)
-        new_settings["lunch_history"] = df_to_list(new_lunch_df)
-        st.session_state.settings = new_settings
-        save_settings_to_sheet(new_settings)
+            # 開始日のない行は捨て、終了日なしは None にする
+            starts = pd.to_datetime(df["start"], errors="coerce")
+            ends = pd.to_datetime(df["end"], errors="coerce")
+            keep = starts.notna()
+            return [{"start": s.date(), "end": e.date() if pd.notna(e) else None}
+                    for s, e in zip(starts[keep], ends[keep])]
+        st.session_state.settings.update({
+            "wage_history": df_to_list(new_wage_df), "transport_history": df_to_list(new_trans_df), "lunch_history": df_to_list(new_lunch_df)
+        })
+        _attach_settings_indexes(st.session_state.settings)
+        save_settings_to_sheet(st.session_state.settings)
         st.success("保存しました"); reload_all_data()
     st.divider()
     st.subheader("4. 毎年繰り返す特別休暇")
@@ -560,20 +936,19 @@ if menu == "マスタ・休暇設定":
         edited_holidays = st.data_editor(st.session_state.special_holidays_list, column_config=column_config_holiday, num_rows="dynamic", use_container_width=True, key="holiday_editor_rec")
     with c_h2:
         if st.button("特別休暇を保存"):
-            st.session_state.special_holidays_list = edited_holidays
+            st.session_state.special_holidays_list = attach_holiday_keys(edited_holidays)
             save_data_to_sheet("holidays", edited_holidays)
             st.success("保存しました"); reload_all_data()
 
 elif menu == "従業員マスタ":
     st.header("👥 従業員マスタ")
     st.info("※「兼務時間」に入力した時間は、主たる職種の時間から差し引かれ、従たる職種の時間として計算されます。")
-    active_staff_df = get_active_staff_df(st.session_state.staff_db, st.session_state.settings, target_date_obj=None)
-    shift_codes = st.session_state.shift_patterns["コード"].tolist() if not st.session_state.shift_patterns.empty else []
-    job_options = ["管理者", "サービス管理責任者", "職業指導員", "生活支援員", "目標工賃達成指導員", "調理員", "運転手", "事務員", "看護職員", "なし"]
+    active_staff_df = get_active_staff_df(st.session_state.staff_db, st.session_state.settings, target_date_obj=None, copy=True)
+    shift_codes = st.session_state._shift_codes
     staff_col_config = {
-        "職種(主)": st.column_config.SelectboxColumn("職種(主)", options=job_options, required=True),
-        "職種(副)": st.column_config.SelectboxColumn("職種(副)", options=job_options, required=False),
-        "雇用形態": st.column_config.SelectboxColumn("雇用形態", options=["常勤", "非常勤"], required=True),
+        "職種(主)": st.column_config.SelectboxColumn("職種(主)", options=JOB_OPTIONS, required=True),
+        "職種(副)": st.column_config.SelectboxColumn("職種(副)", options=JOB_OPTIONS, required=False),
+        "雇用形態": st.column_config.SelectboxColumn("雇用形態", options=EMPLOYMENT_TYPES, required=True),
         "基本シフト": st.column_config.SelectboxColumn("基本シフト", options=shift_codes, required=True),
         "契約時間(週)": st.column_config.NumberColumn("契約時間(週)", format="%.1f h", step=0.5),
         "兼務時間(週)": st.column_config.NumberColumn("兼務時間(週)", format="%.1f h", step=0.5, help="職種(副)に従事する時間"),
@@ -582,9 +957,8 @@ elif menu == "従業員マスタ":
     }
     edited_staff_df = st.data_editor(active_staff_df, column_config=staff_col_config, num_rows="dynamic", use_container_width=True, key="staff_editor")
     if st.button("従業員情報を保存", type="primary"):
-        final_df = edited_staff_df.copy()
-        for idx, row in final_df.iterrows():
-            if row["雇用形態"] == "常勤": final_df.at[idx, "契約時間(週)"] = fulltime_weekly_hours
+        final_df = categorize_staff_columns(edited_staff_df.copy(), st.session_state._shift_codes)
+        final_df.loc[final_df["雇用形態"].eq("常勤").to_numpy(), "契約時間(週)"] = fulltime_weekly_hours
         st.session_state.staff_db = final_df 
         save_data_to_sheet("staff_master", final_df) 
         st.success("保存しました"); reload_all_data()
@@ -614,32 +988,26 @@ elif menu == "実績・人員計算":
         s_month_rec = st.selectbox("対象月", list(range(1, 13)), index=today.month - 1)
         target_ym = f"{s_year_rec}年{s_month_rec}月"
         st.caption(f"登録データ名: **{target_ym}**")
+        rec_calendar = compute_month_calendar(s_year_rec, s_month_rec, closed_days_key, close_on_holiday, sp_holiday_rules)
         
         st.markdown("---")
         st.write("🧑‍🤝‍🧑 **利用者ごとの実績入力**")
         
         if st.button("マスタから初期値をロード"):
-            calc_start = datetime.date(s_year_rec, s_month_rec, 1)
-            calc_last_day = calendar.monthrange(s_year_rec, s_month_rec)[1]
-            calc_end = datetime.date(s_year_rec, s_month_rec, calc_last_day)
-            principle_days = calc_last_day - 8
+            calc_start, calc_end = rec_calendar["first_day"], rec_calendar["last_day"]
+            principle_days = calc_end.day - 8
             
             users_df = st.session_state.users_db
-            temp_rows = []
-            
-            for _, u in users_df.iterrows():
-                start = u["利用開始日"]; end = u["利用終了日"]
-                if not start: continue
-                if start > calc_end: continue
-                if end and end < calc_start: continue
-                
-                u_days = 0
-                if u["支給決定量タイプ"] == "原則日数(月-8)": u_days = principle_days
-                else: u_days = int(u["固定日数"]) if pd.notnull(u["固定日数"]) else 0
-                
-                temp_rows.append({"利用者名": u["利用者名"], "予定日数": u_days, "実績日数": u_days, "備考": ""})
+            # 対象月に利用期間が重なる利用者だけを残し、予定日数は支給決定量タイプで切り替える
+            starts = pd.to_datetime(users_df["利用開始日"], errors="coerce")
+            ends = pd.to_datetime(users_df["利用終了日"], errors="coerce")
+            in_month = (starts.notna() & (starts <= pd.Timestamp(calc_end)) & (ends.isna() | (ends >= pd.Timestamp(calc_start)))).to_numpy()
+            fixed_days = pd.to_numeric(users_df["固定日数"], errors="coerce").fillna(0).astype(int).to_numpy()
+            u_days = np.where(users_df["支給決定量タイプ"].eq("原則日数(月-8)").to_numpy(), principle_days, fixed_days)[in_month]
             
-            st.session_state.temp_users_calc = pd.DataFrame(temp_rows)
+            st.session_state.temp_users_calc = pd.DataFrame({
+                "利用者名": users_df["利用者名"].to_numpy()[in_month], "予定日数": u_days, "実績日数": u_days, "備考": ""
+            })
         
         calculated_total = 0
         if st.session_state.temp_users_calc is not None:
@@ -657,37 +1025,28 @@ elif menu == "実績・人員計算":
                 hide_index=True,
                 key="calc_editor"
             )
-            calculated_total = edited_calc_df["実績日数"].sum()
+            calculated_total = int(np.nansum(edited_calc_df["実績日数"].to_numpy(dtype=float)))
             st.metric("合計延べ利用者数 (集計結果)", f"{calculated_total} 人")
         else:
             st.info("上の「ロード」ボタンを押してリストを表示してください")
 
-        start_date = datetime.date(s_year_rec, s_month_rec, 1)
-        last_day = calendar.monthrange(s_year_rec, s_month_rec)[1]
-        temp_open_days = 0
-        for d_int in range(1, last_day + 1):
-            curr = datetime.date(s_year_rec, s_month_rec, d_int)
-            wd = JP_DAYS[curr.weekday()]
-            if wd not in closed_days_select and not (close_on_holiday and jpholiday.is_holiday(curr)):
-                if not is_special_holiday_recurring(curr, st.session_state.special_holidays_list)[0]:
-                    temp_open_days += 1
+        start_date = rec_calendar["first_day"]
+        temp_open_days = rec_calendar["open_days"]
         
-        current_cap = get_capacity_at_date(start_date, st.session_state.settings.get('capacity_history', []))
-        
-        if temp_open_days > 0 and calculated_total > 0:
-            daily_avg = calculated_total / temp_open_days
-            if daily_avg > current_cap * 1.2:
-                st.error(f"⚠️ 月平均利用率 {daily_avg/current_cap:.0%}。特定日の定員超過リスクがあります。")
+        # 集計結果がまだ無いときは利用率の確認自体が不要なので、定員の検索もしない
+        if calculated_total > 0 and temp_open_days > 0:
+            current_cap = get_capacity_at_date(start_date, st.session_state.settings.get('capacity_history', []), st.session_state.settings.get("_cap_index"))
+            usage_rate = calculated_total / (temp_open_days * current_cap) if current_cap > 0 else 0
+            if usage_rate > 1.2:
+                st.error(f"⚠️ 月平均利用率 {usage_rate:.0%}。特定日の定員超過リスクがあります。")
 
     with col_in2:
         st.metric("自動計算された開所日数", f"{temp_open_days} 日")
         
         if st.button("集計結果を実績として保存", type="primary", disabled=(calculated_total==0)):
-            df_recs = st.session_state.monthly_records
-            df_recs = df_recs[df_recs["年月"] != target_ym]
-            new_row = {"年月": target_ym, "延べ利用者数": calculated_total, "開所日数": temp_open_days}
-            st.session_state.monthly_records = pd.concat([df_recs, pd.DataFrame([new_row])], ignore_index=True)
-            save_data_to_sheet("monthly_records", st.session_state.monthly_records)
+            saved_records_df = upsert_monthly_record(target_ym, calculated_total, temp_open_days)
+            # 年月の解析は保存時に済ませ、平均利用人数の計算で毎回やり直さない
+            st.session_state.monthly_records = with_record_dates(saved_records_df)
             st.success(f"{target_ym} の実績（{calculated_total}人）を保存しました")
             if "temp_users_input" in st.session_state:
                 del st.session_state["temp_users_input"]
@@ -703,15 +1062,12 @@ elif menu == "実績・人員計算":
     
     warning_messages = []
     sets = st.session_state.settings
+    # 計算対象月の在籍職員はこの画面で1回だけ絞り込み、加算の職員チェックと人員計算で使い回す
+    calc_staff_df = get_active_staff_df(st.session_state.staff_db, sets, target_date_obj=calc_target_date)
     def check_addon_period_strict(history_key, roles, name):
-        is_active = is_addon_active(calc_target_date, sets.get(history_key, []))
+        is_active = is_addon_active(calc_target_date, sets.get(history_key, []), sets.get(f"_{history_key}_arr"))
         if is_active:
-            valid_staff = get_active_staff_df(st.session_state.staff_db, sets, target_date_obj=calc_target_date)
-            has_role = False
-            for _, r in valid_staff.iterrows():
-                if r["職種(主)"] in roles or r["職種(副)"] in roles:
-                    has_role = True
-                    break
+            has_role = bool(calc_staff_df["職種(主)"].isin(roles).any() or calc_staff_df["職種(副)"].isin(roles).any())
             if not has_role: warning_messages.append(f"⚠️ {name}期間中ですが有効な『{'・'.join(roles)}』が不在です。")
         return is_active
     wage_active = check_addon_period_strict("wage_history", ["目標工賃達成指導員"], "目標工賃達成指導員加算")
@@ -721,7 +1077,7 @@ elif menu == "実績・人員計算":
         for msg in warning_messages: st.error(msg)
     else: st.success("✅ 加算要件OK")
 
-    calc_result = calculate_average_users_detail(calc_target_date, st.session_state.settings["opening_date"], st.session_state.settings.get("capacity_history", []), st.session_state.monthly_records)
+    calc_result = calculate_average_users_detail(calc_target_date, st.session_state.settings["opening_date"], st.session_state.settings.get("capacity_history", []), st.session_state.monthly_records, st.session_state.settings.get("_cap_index"))
     avg_users = calc_result["result"]
     
     c_res1, c_res2 = st.columns([1.5, 1])
@@ -748,33 +1104,7 @@ elif menu == "実績・人員計算":
             st.write(f"- ＋ 目標工賃達成指導員 **{wage_staff_req}人**")
         
         st.markdown("**現在のマスタと照合（兼務考慮）**")
-        current_staff_df = get_active_staff_df(st.session_state.staff_db, st.session_state.settings, target_date_obj=calc_target_date)
-        actual_base_fte = 0.0
-        actual_wage_fte = 0.0
-        base_roles = ["職業指導員", "生活支援員"]
-        wage_roles = ["目標工賃達成指導員"]
-        details_log = []
-        
-        for _, staff in current_staff_df.iterrows():
-            total_h = staff["契約時間(週)"]; sub_h = staff["兼務時間(週)"]
-            try: total_h=float(total_h); sub_h=float(sub_h)
-            except: total_h=0; sub_h=0
-            main_h = max(0, total_h - sub_h)
-            
-            if staff["職種(主)"] in base_roles:
-                fte = main_h / fulltime_weekly_hours; actual_base_fte += fte; 
-                if fte>0: details_log.append(f"{staff['名前']}(主): 支援員等 {fte:.2f}人分")
-            elif staff["職種(主)"] in wage_roles:
-                fte = main_h / fulltime_weekly_hours; actual_wage_fte += fte; 
-                if fte>0: details_log.append(f"{staff['名前']}(主): 目標工賃 {fte:.2f}人分")
-            
-            if staff["職種(副)"] in base_roles:
-                fte = sub_h / fulltime_weekly_hours; actual_base_fte += fte; 
-                if fte>0: details_log.append(f"{staff['名前']}(副): 支援員等 {fte:.2f}人分")
-            elif staff["職種(副)"] in wage_roles:
-                fte = sub_h / fulltime_weekly_hours; actual_wage_fte += fte; 
-                if fte>0: details_log.append(f"{staff['名前']}(副): 目標工賃 {fte:.2f}人分")
-
+        actual_base_fte, actual_wage_fte, details_log = compute_staff_fte(calc_staff_df, fulltime_weekly_hours)
         total_actual = actual_base_fte + actual_wage_fte
         st.metric("配置可能人員", f"{total_actual:.2f} 人")
         
@@ -788,7 +1118,7 @@ elif menu == "実績・人員計算":
             if not is_wage_ok: st.write(f"- 目標工賃担当が {round(wage_staff_req - actual_wage_fte, 2)}人 不足")
         
         with st.expander("詳細内訳"):
-            for d in details_log: st.write(f"- {d}")
+            for name, tag, kind, fte in details_log: st.write(f"- {name}({tag}): {kind} {fte:.2f}人分")
 
 elif menu == "シフト作成":
     st.header("📝 シフト作成")
@@ -799,58 +1129,46 @@ elif menu == "シフト作成":
     
     shift_staff_df = get_active_staff_df(st.session_state.staff_db, st.session_state.settings, target_date_obj=shift_month)
     shift_staff_names = shift_staff_df["名前"].tolist()
-    shift_opts = st.session_state.shift_patterns["コード"].tolist() + ["休", "公休", "有給"]
-    
-    start_dt = shift_month.replace(day=1)
-    end_dt = start_dt + relativedelta(months=1) - datetime.timedelta(days=1)
-    dates = pd.date_range(start_dt, end_dt)
-    date_cols = []; holiday_cols = []
     
-    for d in dates:
-        d_label = f"{d.day}({JP_DAYS[d.weekday()]})"
-        date_cols.append(d_label)
-        is_holiday = False
-        wd_str = JP_DAYS[d.weekday()]
-        if wd_str in closed_days_select: is_holiday = True
-        elif close_on_holiday and jpholiday.is_holiday(d.date()): is_holiday = True
-        else:
-            is_sp, _ = is_special_holiday_recurring(d.date(), st.session_state.special_holidays_list)
-            if is_sp: is_holiday = True
-        if is_holiday: holiday_cols.append(d_label)
+    shift_calendar = compute_month_calendar(shift_month.year, shift_month.month, closed_days_key, close_on_holiday, sp_holiday_rules)
+    date_cols = list(shift_calendar["date_labels"]); holiday_cols = list(shift_calendar["holiday_labels"])
 
     if st.button("シフト案を新規自動生成", type="primary"):
-        rows = []
-        for _, staff in shift_staff_df.iterrows():
-            s_name = staff["名前"]
-            row_data = {"氏名": s_name}
-            for d in dates:
-                d_label = f"{d.day}({JP_DAYS[d.weekday()]})"
-                is_closed = (d_label in holiday_cols)
-                if is_closed: row_data[d_label] = "休"
-                elif JP_DAYS[d.weekday()] in staff["固定休"]: row_data[d_label] = "公休"
-                else: row_data[d_label] = staff["基本シフト"]
-            rows.append(row_data)
-        new_df = pd.DataFrame(rows)
+        # (職員, 日付) の表を配列でまとめて作る: 休業日は「休」、固定休の曜日は「公休」、それ以外は基本シフト
+        holiday_mask = np.array(shift_calendar["holiday_mask"], dtype=bool)
+        # 固定休は種類が少ないので、異なる文字列ごとに文字の frozenset で曜日(1文字)を引いた (種類, 7) 表を作り職員へ展開する
+        off_codes, off_values = pd.factorize(shift_staff_df["固定休"].fillna("").astype(str))
+        off_table = np.array([[w in chars for w in JP_DAYS] for chars in map(frozenset, off_values)], dtype=bool).reshape(-1, 7)
+        off_weekdays = off_table[off_codes]
+        fixed_off = off_weekdays[:, np.array(shift_calendar["weekdays"], dtype=np.int8)]
+        # 先頭列に氏名、残りに基本シフトを横に展開した1枚の配列を作り、固定休→休業日の順にその場で上書きする
+        grid = np.empty((len(shift_staff_df), len(date_cols) + 1), dtype=object)
+        grid[:, 0] = shift_staff_df["名前"].to_numpy(dtype=object)
+        grid[:, 1:] = shift_staff_df["基本シフト"].to_numpy(dtype=object)[:, None]
+        grid[:, 1:][fixed_off] = "公休"
+        grid[:, 1:][:, holiday_mask] = "休"
+        new_df = pd.DataFrame(grid, columns=["氏名"] + date_cols)
         st.session_state.current_shift_df = new_df
         save_data_to_sheet("current_shift_draft", new_df)
         st.success("新規作成しました"); reload_all_data()
 
     if st.session_state.current_shift_df is not None:
         current_df = st.session_state.current_shift_df
-        column_config = {"氏名": st.column_config.TextColumn("氏名", disabled=True)}
-        for d_col in date_cols:
-            if d_col in current_df.columns:
-                column_config[d_col] = st.column_config.SelectboxColumn(d_col, options=shift_opts, required=True, width="small")
         display_cols = ["氏名"] + [c for c in date_cols if c in current_df.columns]
+        column_config = make_shift_col_config(tuple(display_cols[1:]), st.session_state._shift_opts)
         edited_df = st.data_editor(current_df[display_cols], column_config=column_config, use_container_width=True, height=400, hide_index=True, key="shift_editor_h_key")
         st.session_state.current_shift_df = edited_df
-        save_data_to_sheet("current_shift_draft", edited_df)
+        draft_hash = frame_digest(edited_df)
+        # 下書きは編集のたびではなくボタンが押されたときだけ、他セッションの変更に関係なく必ず書き込む
+        if st.button("下書きをクラウドに保存"):
+            save_data_to_sheet("current_shift_draft", edited_df)
+            st.success("下書きを保存しました")
         
-        def highlight_holidays_col(data):
-            style_df = pd.DataFrame('', index=data.index, columns=data.columns)
-            for col in holiday_cols:
-                if col in style_df.columns: style_df[col] = 'background-color: #ffe6e6; color: #cc0000'
-            return style_df
-        st.dataframe(edited_df.style.apply(highlight_holidays_col, axis=None), use_container_width=True, height=600, hide_index=True)
-        csv_out = edited_df.to_csv(index=False).encode('utf-8-sig')
-        st.download_button("シフト表をPCに保存 (CSV)", csv_out, "shift_h_final.csv", "text/csv")
+        # 休日列のスタイルは列ごとの CSS を行方向に広げた表で一度に渡す (セルごとの関数呼び出しをしない)
+        styler = edited_df.style.apply(holiday_style_frame, axis=None, holiday_cols=holiday_cols)
+        st.dataframe(styler, use_container_width=True, height=600, hide_index=True)
+        # CSV は下書きの内容が変わったときだけ作り直す
+        if st.session_state.get("_shift_csv_key") != draft_hash:
+            st.session_state._shift_csv = edited_df.to_csv(index=False).encode('utf-8-sig')
+            st.session_state._shift_csv_key = draft_hash
+        st.download_button("シフト表をPCに保存 (CSV)", st.session_state._shift_csv, "shift_h_final.csv", "text/csv")